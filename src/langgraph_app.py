@@ -1,24 +1,27 @@
 from __future__ import annotations
 
+import functools
 import os
 from pathlib import Path
 from typing import List, TypedDict, Optional, Dict, Any
 
 from langgraph.graph import StateGraph, START, END
 
-from .rag import build_retriever
+from .rag import build_retriever, kb_lines_from_text
+from .llm_json import parse_json
 from .logic_engine import Atom, parse_program, prove
 from .no_key_llm import NoKeyLLM
 
 try:
     from langchain_openai import ChatOpenAI
-    from langchain_core.output_parsers import JsonOutputParser
+    from langchain_core.messages import HumanMessage, SystemMessage
 except Exception:
     ChatOpenAI = None
-    JsonOutputParser = None
+    HumanMessage = SystemMessage = None
 
 
-FORMULATE_PROMPT = """You are translating a natural language logic question into a Prolog-like Horn clause program.
+# Fixed instructions in the system message; KB snippets + question in the user message.
+FORMULATE_SYSTEM = """You are translating a natural language logic question into a Prolog-like Horn clause program.
 
 You MUST output JSON with keys:
 - "program": string containing facts/rules (each ending with a period).
@@ -30,8 +33,9 @@ Constraints:
 - Variables start with uppercase letters (X, Y, Z).
 - No negation, no arithmetic, no lists.
 - Use the provided KB snippets as-is when possible instead of inventing new predicates.
+"""
 
-KB SNIPPETS:
+FORMULATE_USER = """KB SNIPPETS:
 {kb}
 
 QUESTION:
@@ -51,23 +55,26 @@ KB Snippets:
 {kb}
 """
 
-REFINE_PROMPT = """Your previous symbolic program failed in the solver.
-
-ERROR:
-{error}
+REFINE_SYSTEM = """Your previous symbolic program failed in the solver.
 
 Fix the program/query to satisfy the constraints. Output JSON:
 {
   "program": "...",
   "query": "...."
 }
+"""
+
+REFINE_USER = """ERROR:
+{error}
 
 Original attempt:
 {attempt}
 """
 
 
-class LGState(TypedDict):
+# total=False: nodes return only the keys they change and LangGraph merges them into
+# the state, instead of each node copying the whole state dict.
+class LGState(TypedDict, total=False):
     question: str
 
     kb_list: List[str]
@@ -87,6 +94,7 @@ class LGState(TypedDict):
     refined: bool
 
 
+@functools.lru_cache(maxsize=256)
 def _parse_query_atom(q: str) -> Atom:
     q = q.strip().rstrip(".")
     if "(" not in q:
@@ -99,17 +107,15 @@ def _parse_query_atom(q: str) -> Atom:
 
 def build_langgraph_app(kb_path: str, model: str = "gpt-4o-mini"):
     retriever = build_retriever(kb_path)
-    full_kb_text = Path(kb_path).read_text(encoding="utf-8")
+    full_kb_list = kb_lines_from_text(Path(kb_path).read_text(encoding="utf-8"))
 
     # Use real LLM only if a real key exists
     use_real_llm = bool(os.getenv("OPENAI_API_KEY")) and os.getenv("OPENAI_API_KEY") != "paste_yours_here" and (ChatOpenAI is not None)
 
     if use_real_llm:
         llm = ChatOpenAI(model=model, temperature=0)
-        parser = JsonOutputParser()
     else:
         llm = NoKeyLLM()
-        parser = None
 
     def retrieve(state: LGState) -> LGState:
         # Still do retrieval for the assignment checkbox,
@@ -121,49 +127,55 @@ def build_langgraph_app(kb_path: str, model: str = "gpt-4o-mini"):
 
         # In no-key mode, set kb to the FULL KB so proofs actually work deterministically.
         if not use_real_llm:
-            kb_list = [line.strip() for line in full_kb_text.splitlines() if line.strip() and not line.strip().startswith("%")]
+            kb_list = full_kb_list
             kb = "\n".join(kb_list)
 
-        return {**state, "kb_list": kb_list, "kb": kb}
+        return {"kb_list": kb_list, "kb": kb}
 
     def judge_relevance(state: LGState) -> LGState:
         if use_real_llm:
             resp = llm.invoke(RELEVANCE_PROMPT.format(question=state["question"], kb=state["kb"])).content
-            data = parser.parse(resp)
+            data = parse_json(resp, ("relevant", "reason"))
         else:
             data = llm.relevance(state["question"], state["kb"])
-        return {**state, "relevant": bool(data["relevant"]), "relevance_reason": str(data["reason"])}
+        return {"relevant": bool(data["relevant"]), "relevance_reason": str(data["reason"])}
 
     def retrieve_more(state: LGState) -> LGState:
-        return {**state, "k": 16}
+        return {"k": 16}
 
     def formulate(state: LGState) -> LGState:
         if use_real_llm:
-            resp = llm.invoke(FORMULATE_PROMPT.format(kb=state["kb"], question=state["question"])).content
-            data = parser.parse(resp)
-            return {**state, "program": data["program"], "query": data["query"]}
+            resp = llm.invoke([
+                SystemMessage(content=FORMULATE_SYSTEM),
+                HumanMessage(content=FORMULATE_USER.format(kb=state["kb"], question=state["question"])),
+            ]).content
+            data = parse_json(resp, ("program", "query"))
+            return {"program": data["program"], "query": data["query"]}
         else:
             data = llm.formulate(state["question"], state["kb"])
             # IMPORTANT: use the full KB as the "program"
-            return {**state, "program": state["kb"], "query": data["query"]}
+            return {"program": state["kb"], "query": data["query"]}
 
     def solve(state: LGState) -> LGState:
         try:
             program = parse_program(state["program"])
             query = _parse_query_atom(state["query"])
-            ok, trace = prove(program, query)
-            return {**state, "ok": bool(ok), "trace": trace, "error": None}
+            ok, trace = prove(program, query, trace=True)
+            return {"ok": bool(ok), "trace": trace, "error": None}
         except Exception as e:
-            return {**state, "ok": False, "trace": [], "error": str(e)}
+            return {"ok": False, "trace": [], "error": str(e)}
 
     def refine(state: LGState) -> LGState:
         attempt: Dict[str, Any] = {"program": state["program"], "query": state["query"]}
         if use_real_llm:
-            resp = llm.invoke(REFINE_PROMPT.format(error=state["error"], attempt=attempt)).content
-            data = parser.parse(resp)
+            resp = llm.invoke([
+                SystemMessage(content=REFINE_SYSTEM),
+                HumanMessage(content=REFINE_USER.format(error=state["error"], attempt=attempt)),
+            ]).content
+            data = parse_json(resp, ("program", "query"))
         else:
             data = llm.refine(state["error"] or "", attempt)
-        return {**state, "program": data["program"], "query": data["query"], "refined": True}
+        return {"program": data["program"], "query": data["query"], "refined": True}
 
     def route_relevance(state: LGState) -> str:
         return "formulate" if state.get("relevant", True) else "retrieve_more"
@@ -0,0 +1,29 @@
+from __future__ import annotations
+import json
+import re
+from typing import Any, Dict, Tuple
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from langchain_core.output_parsers import JsonOutputParser
+
+_JSON_FENCE_RE = re.compile(r"^\s*```(?:json)?\s*|\s*```\s*$")
+_loads = orjson.loads if orjson is not None else json.loads
+_TEXT_KEYS = ("program", "query")  # parsed by the solver, so they must be strings
+
+def parse_json(text: str, keys: Tuple[str, ...] = ("program", "query")) -> Dict[str, Any]:
+    # Fast path: plain (optionally ```json-fenced) JSON. Anything messier falls back
+    # to JsonOutputParser, which tolerates partial/markdown-wrapped output.
+    try:
+        data = _loads(_JSON_FENCE_RE.sub("", text))
+    except ValueError:
+        data = JsonOutputParser().parse(text)
+    if not isinstance(data, dict) or any(k not in data for k in keys):
+        raise ValueError(f"LLM output is not a JSON object with keys {list(keys)}: {text!r}")
+    bad = [k for k in keys if k in _TEXT_KEYS and not isinstance(data[k], str)]
+    if bad:
+        raise ValueError(f"LLM output has non-string {bad}: {text!r}")
+    return data
@@ -1,9 +1,11 @@
 from __future__ import annotations
-from dataclasses import dataclass
-from typing import Dict, List, Optional, Tuple
+import functools
+import weakref
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Set, Tuple
 
 Term = str  # variables start with uppercase or "_"
-Subst = Dict[str, Term]
+TrailMark = int
 
 @dataclass(frozen=True)
 class Atom:
@@ -23,51 +25,109 @@ class Rule:
 def is_var(t: Term) -> bool:
     return len(t) > 0 and (t[0].isupper() or t[0] == "_")
 
-def apply_subst_term(t: Term, s: Subst) -> Term:
-    while is_var(t) and t in s and s[t] != t:
-        t = s[t]
-    return t
+class Bindings:
+    """
+    One mutable substitution shared by the whole search. Bindings are recorded on a
+    trail so backtracking is `undo(mark())` instead of copying a dict per unification.
+    """
+    __slots__ = ("parent", "trail")
+
+    def __init__(self) -> None:
+        self.parent: Dict[Term, Term] = {}
+        self.trail: List[Tuple[Term, Optional[Term]]] = []  # (var, previous value or None)
 
-def apply_subst_atom(a: Atom, s: Subst) -> Atom:
-    return Atom(a.pred, tuple(apply_subst_term(x, s) for x in a.args))
+    def find(self, t: Term) -> Term:
+        parent = self.parent
+        root = t
+        while root in parent:
+            root = parent[root]
+        # Path compression is trailed too, so undo() restores the original chain.
+        while parent.get(t, root) != root:
+            nxt = parent[t]
+            self.trail.append((t, nxt))
+            parent[t] = root
+            t = nxt
+        return root
 
-def unify_terms(t1: Term, t2: Term, s: Subst) -> Optional[Subst]:
-    t1 = apply_subst_term(t1, s)
-    t2 = apply_subst_term(t2, s)
+    def bind(self, var: Term, t: Term) -> None:
+        self.parent[var] = t
+        self.trail.append((var, None))
+
+    def mark(self) -> TrailMark:
+        return len(self.trail)
+
+    def undo(self, mark: TrailMark) -> None:
+        parent, trail = self.parent, self.trail
+        while len(trail) > mark:
+            var, old = trail.pop()
+            if old is None:
+                del parent[var]
+            else:
+                parent[var] = old
+
+def apply_subst_term(t: Term, s: Bindings) -> Term:
+    return s.find(t)
+
+def apply_subst_atom(a: Atom, s: Bindings) -> Atom:
+    parent = s.parent
+    if not any(x in parent for x in a.args):
+        return a  # nothing bound (e.g. ground atoms): no new tuple
+    return Atom(a.pred, tuple(s.find(x) for x in a.args))
+
+def unify_terms(t1: Term, t2: Term, s: Bindings) -> bool:
+    t1 = s.find(t1)
+    t2 = s.find(t2)
 
     if t1 == t2:
-        return s
+        return True
 
     if is_var(t1):
-        s2 = dict(s); s2[t1] = t2
-        return s2
+        s.bind(t1, t2)
+        return True
 
     if is_var(t2):
-        s2 = dict(s); s2[t2] = t1
-        return s2
+        s.bind(t2, t1)
+        return True
 
-    return None
+    return False
 
-def unify_atoms(a1: Atom, a2: Atom, s: Subst) -> Optional[Subst]:
+def unify_args(xs: Tuple[Term, ...], ys: Tuple[Term, ...], s: Bindings) -> bool:
+    """Unify two same-length argument tuples in place; on failure partial bindings are undone."""
+    m = s.mark()
+    for x, y in zip(xs, ys):
+        if not unify_terms(x, y, s):
+            s.undo(m)
+            return False
+    return True
+
+def unify_atoms(a1: Atom, a2: Atom, s: Bindings) -> bool:
     if a1.pred != a2.pred or len(a1.args) != len(a2.args):
-        return None
-    s2 = dict(s)
-    for x, y in zip(a1.args, a2.args):
-        s2 = unify_terms(x, y, s2)
-        if s2 is None:
-            return None
-    return s2
+        return False
+    return unify_args(a1.args, a2.args, s)
+
+# Weak values: atoms of programs that are no longer referenced (e.g. evicted from the
+# parse_program cache) are dropped instead of accumulating.
+_ATOMS: "weakref.WeakValueDictionary[Tuple[str, Tuple[Term, ...]], Atom]" = weakref.WeakValueDictionary()
+
+def _intern_atom(pred: str, args: Tuple[Term, ...]) -> Atom:
+    """Share one Atom object per (pred, args) across everything that gets parsed."""
+    key = (pred, args)
+    a = _ATOMS.get(key)
+    if a is None:
+        a = _ATOMS[key] = Atom(pred, args)
+    return a
 
 def _split_args(arg_str: str) -> List[str]:
     return [x.strip() for x in arg_str.split(",") if x.strip()]
 
+@functools.lru_cache(maxsize=4096)
 def _parse_atom(text: str) -> Atom:
     text = text.strip().rstrip(".")
     if "(" not in text:
-        return Atom(text, tuple())
+        return _intern_atom(text, tuple())
     pred, rest = text.split("(", 1)
     args = rest.rsplit(")", 1)[0]
-    return Atom(pred.strip(), tuple(_split_args(args)))
+    return _intern_atom(pred.strip(), tuple(_split_args(args)))
 
 def _split_body(body: str) -> List[str]:
     parts, cur, depth = [], [], 0
@@ -86,7 +146,136 @@ def _split_body(body: str) -> List[str]:
         parts.append(last)
     return parts
 
-def parse_program(program_text: str) -> List[Rule]:
+# Generating a matcher costs about as much as ten scans of its predicate's clauses, so
+# one is only built for a predicate with enough clauses that keeps being scanned.
+_MATCHER_MIN_CLAUSES = 8
+_MATCHER_MIN_SCANS = 16
+
+def _compile_matcher(ids: List[int], head_args: List[Tuple[Term, ...]]) -> Callable[[Tuple[Term, ...]], List[int]]:
+    """Generate a filter returning the clause ids in `ids` whose head constants agree with the goal args."""
+    arity = len(head_args[ids[0]])
+    src = [
+        "def _m(args):",
+        f"    {', '.join(f'a{j}' for j in range(arity))}, = args",
+        "    " + "; ".join(f"v{j} = is_var(a{j})" for j in range(arity)),
+        "    out = []",
+    ]
+    for rid in ids:
+        tests = [f"(v{j} or a{j} == {t!r})" for j, t in enumerate(head_args[rid]) if not is_var(t)]
+        src.append(f"    if {' and '.join(tests) or 'True'}: out.append({rid})")
+    src.append("    return out")
+    env: Dict[str, object] = {"is_var": is_var}
+    exec(compile("\n".join(src), "<kb>", "exec"), env)
+    return env["_m"]
+
+def _recursive_preds(by_pred: Dict[Tuple[str, int], List[int]], bodies: List[Tuple[Atom, ...]]) -> Set[Tuple[str, int]]:
+    """Predicates on a cycle of the call graph (Tarjan's SCCs): the ones worth tabling."""
+    calls = {pa: {(a.pred, len(a.args)) for rid in ids for a in bodies[rid]} for pa, ids in by_pred.items()}
+    order: Dict[Tuple[str, int], int] = {}
+    low: Dict[Tuple[str, int], int] = {}
+    stack: List[Tuple[str, int]] = []
+    on_stack: Set[Tuple[str, int]] = set()
+    out: Set[Tuple[str, int]] = set()
+
+    for root in calls:
+        if root in order:
+            continue
+        order[root] = low[root] = len(order)
+        stack.append(root)
+        on_stack.add(root)
+        # Explicit DFS stack: a long chain of predicates must not hit the recursion limit.
+        work = [(root, iter(calls[root]))]
+        while work:
+            v, edges = work[-1]
+            for w in edges:
+                if w not in order:
+                    order[w] = low[w] = len(order)
+                    stack.append(w)
+                    on_stack.add(w)
+                    work.append((w, iter(calls.get(w, ()))))
+                    break
+                if w in on_stack:
+                    low[v] = min(low[v], order[w])
+            else:
+                work.pop()
+                if work:
+                    u = work[-1][0]
+                    low[u] = min(low[u], low[v])
+                if low[v] == order[v]:
+                    scc = []
+                    while True:
+                        w = stack.pop()
+                        on_stack.discard(w)
+                        scc.append(w)
+                        if w == v:
+                            break
+                    if len(scc) > 1 or v in calls.get(v, ()):
+                        out.update(scc)
+    return out
+
+@dataclass
+class Program:
+    """
+    Parsed clauses stored as parallel arrays (clause i is
+    head_preds[i](head_args[i]) :- bodies[i]); every lookup returns clause ids.
+
+    First-argument index: heads whose first argument is a constant go into `index`,
+    heads with a variable (or no) first argument into `wild`.
+    """
+    head_preds: List[str]
+    head_args: List[Tuple[Term, ...]]
+    bodies: List[Tuple[Atom, ...]]
+    index: Dict[Tuple[str, int, Term], List[int]] = field(default_factory=dict, repr=False)
+    wild: Dict[Tuple[str, int], List[int]] = field(default_factory=dict, repr=False)
+    by_pred: Dict[Tuple[str, int], List[int]] = field(default_factory=dict, repr=False)
+    # generated head filters, built on demand by candidates() (see _compile_matcher)
+    matchers: Dict[Tuple[str, int], Callable[[Tuple[Term, ...]], List[int]]] = field(default_factory=dict, repr=False)
+    scans: Dict[Tuple[str, int], int] = field(default_factory=dict, repr=False)
+    ground_facts: Set[Tuple[str, Tuple[Term, ...]]] = field(default_factory=set, repr=False)
+    has_vars: List[bool] = field(default_factory=list, repr=False)  # clause needs renaming apart
+    tabled: Set[Tuple[str, int]] = field(default_factory=set, repr=False)  # recursive predicates
+
+    def __post_init__(self) -> None:
+        for rid, (pred, args) in enumerate(zip(self.head_preds, self.head_args)):
+            pa = (pred, len(args))
+            self.by_pred.setdefault(pa, []).append(rid)
+            if args and not is_var(args[0]):
+                self.index.setdefault(pa + (args[0],), []).append(rid)
+            else:
+                self.wild.setdefault(pa, []).append(rid)
+            body = self.bodies[rid]
+            self.has_vars.append(any(is_var(t) for t in args) or any(is_var(t) for a in body for t in a.args))
+            if not body and not self.has_vars[rid]:
+                self.ground_facts.add((pred, args))
+
+        self.tabled = _recursive_preds(self.by_pred, self.bodies)
+
+    @classmethod
+    def from_rules(cls, rules: List[Rule]) -> Program:
+        return cls(
+            head_preds=[r.head.pred for r in rules],
+            head_args=[r.head.args for r in rules],
+            bodies=[r.body for r in rules],
+        )
+
+    def candidates(self, goal: Atom) -> List[int]:
+        pa = (goal.pred, len(goal.args))
+        if not goal.args or is_var(goal.args[0]):
+            matcher = self.matchers.get(pa)
+            if matcher is not None:
+                return matcher(goal.args)
+            ids = self.by_pred.get(pa, [])
+            if goal.args and len(ids) >= _MATCHER_MIN_CLAUSES:
+                n = self.scans[pa] = self.scans.get(pa, 0) + 1
+                if n >= _MATCHER_MIN_SCANS:
+                    self.matchers[pa] = _compile_matcher(ids, self.head_args)
+            return ids
+        return self.index.get(pa + (goal.args[0],), []) + self.wild.get(pa, [])
+
+@functools.lru_cache(maxsize=32)
+def parse_program(program_text: str) -> Program:
+    # Cached on the text: callers re-parse the same KB on every solve/refine, and the
+    # returned Program is only ever read (apart from its on-demand matcher cache).
     rules: List[Rule] = []
     for raw in program_text.splitlines():
         line = raw.strip()
@@ -100,44 +289,257 @@ def parse_program(program_text: str) -> List[Rule]:
         else:
             head = _parse_atom(line)
             rules.append(Rule(head=head, body=tuple()))
-    return rules
+    return Program.from_rules(rules)
+
+# Renamed and canonical variables carry a ",<n>" suffix, which no parsed term can contain.
+
+def _canonical(a: Atom, s: Optional[Bindings] = None) -> Atom:
+    """Instantiate `a` under `s` and rename its variables to _,0 / _,1 / ... (variant key)."""
+    names: Dict[Term, Term] = {}
+    args = []
+    for t in a.args:
+        if s is not None:
+            t = s.find(t)
+        if is_var(t):
+            t = names.setdefault(t, f"_,{len(names)}")
+        args.append(t)
+    return Atom(a.pred, tuple(args))
+
+def _rename(a: Atom, suffix: str) -> Atom:
+    """Rename variables apart by appending `suffix`; ground atoms are returned as-is."""
+    if not any(is_var(t) for t in a.args):
+        return a
+    return Atom(a.pred, tuple(t + suffix if is_var(t) else t for t in a.args))
+
+def _show(a: Atom) -> str:
+    if not a.args:
+        return a.pred
+    return f"{a.pred}({', '.join(t.split(',', 1)[0] for t in a.args)})"
+
+# Trace entries stay unformatted during search: ("goal" | "fact" | "rule", atom, body).
+TraceEntry = Tuple[str, Atom, Tuple[Atom, ...]]
+Answer = Tuple[Atom, List[TraceEntry]]  # instantiated goal + proof trace of that answer
+Goals = Optional[Tuple[Atom, "Goals"]]  # goal list as cons cells: pushing a body never copies the rest
+_NO_MATCH = object()
+_BACKTRACK = object()  # frame continuation: retry the newest choicepoint
+
+class _Frame:
+    """One pass over a tabled goal's clauses (goal None: the query itself)."""
+    __slots__ = ("goal", "alts", "k", "dep", "rerun", "s", "cps", "entries", "goals", "members", "next", "before")
 
-def prove(program: List[Rule], query: Atom, max_depth: int = 50) -> Tuple[bool, List[str]]:
+    def __init__(self, goal: Optional[Atom], alts: List[int], dep: int, rerun: bool) -> None:
+        self.goal = goal
+        self.alts = alts
+        self.k = 0
+        self.dep = dep  # lowest incomplete slot this pass consumed answers from
+        self.rerun = rerun  # a leader's re-evaluation pass rather than a first call
+        self.s = Bindings()
+        self.cps: List[list] = []
+        self.entries: List[TraceEntry] = []
+        self.goals: object = _BACKTRACK
+        self.members: Optional[List[Atom]] = None  # leader only: tables re-run this round
+        self.next = 0
+        self.before = -1
+
+def _rename_entries(entries: List[TraceEntry], names: Dict[Term, Term]) -> List[TraceEntry]:
+    """Rewrite a table's answer trace from the producer's canonical variables to the caller's terms."""
+    def sub(a: Atom) -> Atom:
+        return Atom(a.pred, tuple(names.get(t, t) for t in a.args))
+    return [(tag, sub(atom), tuple(sub(x) for x in body)) for tag, atom, body in entries]
+
+def _format_trace(entries: List[TraceEntry]) -> List[str]:
+    lines = []
+    for tag, atom, body in entries:
+        if tag == "goal":
+            lines.append(f"Goal: {_show(atom)}")
+        elif tag == "fact":
+            lines.append(f"  Matched FACT: {_show(atom)}")
+        else:
+            lines.append(f"  Matched RULE: {_show(atom)} :- {', '.join(_show(a) for a in body)}")
+    return lines
+
+def prove(program: Program, query: Atom, trace: bool = False) -> Tuple[bool, List[str]]:
     """
-    Backtracking proof search (depth-first). Returns first proof found + trace.
+    Backtracking proof search with tabling for recursive predicates.
+    Returns first proof found + trace (the trace is empty unless `trace=True`).
     """
+    table: Dict[Atom, List[Answer]] = {}
+    seen: Dict[Atom, Set[Atom]] = {}
+    complete: Set[Atom] = set()
+    cstack: List[Atom] = []  # incomplete tables, oldest first; a table keeps its slot until completed
+    cpos: Dict[Atom, int] = {}
+    low: Dict[Atom, int] = {}  # finished-but-incomplete table -> lowest slot it depends on
+    running: Set[Atom] = set()
+    added = [0]
+    fresh = [0]
+    head_args, bodies, has_vars = program.head_args, program.bodies, program.has_vars
+    tabled, ground_facts = program.tabled, program.ground_facts
 
-    def dfs(goals: List[Atom], s: Subst, depth: int, trace: List[str]) -> Tuple[Optional[Subst], List[str]]:
-        if depth > max_depth:
-            return None, trace + [f"Depth limit reached at goals: {[str(apply_subst_atom(g, s)) for g in goals]}"]
+    def resolve(rid: int, goal: Atom, s: Bindings, rest: Goals, entries: List[TraceEntry]) -> object:
+        # One resolution step against clause `rid`, renamed apart. Returns the new goal
+        # list, or _NO_MATCH (with nothing bound) if the head does not unify.
+        hargs, body = head_args[rid], bodies[rid]
+        if has_vars[rid]:
+            fresh[0] += 1
+            sfx = f",{fresh[0]}"
+            hargs = tuple(t + sfx if is_var(t) else t for t in hargs)
+            body = tuple(_rename(a, sfx) for a in body)
+        # candidates() already matched pred/arity, so only the args are unified
+        if not unify_args(hargs, goal.args, s):
+            return _NO_MATCH
+        if trace:
+            head_s = Atom(goal.pred, tuple(s.find(t) for t in hargs))
+            if not body:
+                entries.append(("fact", head_s, ()))
+            else:
+                entries.append(("rule", head_s, tuple(apply_subst_atom(a, s) for a in body)))
+        for a in reversed(body):
+            rest = (a, rest)
+        return rest
 
-        if not goals:
-            return s, trace
+    def start(goal: Atom, rerun: bool) -> _Frame:
+        running.add(goal)
+        return _Frame(goal, program.candidates(goal), cpos[goal] + 1, rerun)
 
-        goal = apply_subst_atom(goals[0], s)
+    def finish(f: _Frame) -> None:
+        # `f` (already popped) is done: leave it incomplete under an older call, or
+        # complete it together with every table above its slot.
+        pos = cpos[f.goal]
+        if f.dep < pos:
+            low[f.goal] = f.dep
+            frames[-1].dep = min(frames[-1].dep, f.dep)
+            return
+        for g in cstack[pos:]:
+            complete.add(g)
+            del cpos[g]
+            low.pop(g, None)
+        del cstack[pos:]
 
-        # Try each rule/fact that unifies with current goal; if downstream fails, backtrack to next one.
-        for r in program:
-            s2 = unify_atoms(r.head, goal, s)
-            if s2 is None:
+    # Frames are stacked instead of nested in Python calls: a consumer pushes a
+    # choicepoint over the new table's answer list, then the producer's frame on top.
+    root = _Frame(None, [], 0, False)
+    root.goals = (query, None)
+    frames = [root]
+    f = root
+    while True:
+        s, cps, entries, goals = f.s, f.cps, f.entries, f.goals
+        while True:
+            if goals is None:
+                if f.goal is None:
+                    return True, _format_trace(entries)
+                ans = _canonical(f.goal, s)
+                answer_set = seen[f.goal]
+                if ans not in answer_set:
+                    answer_set.add(ans)
+                    table[f.goal].append((ans, list(entries)))
+                    added[0] += 1
+                goals = _BACKTRACK
+            if goals is _BACKTRACK:
+                goals = _NO_MATCH
+                while cps:
+                    cp = cps[-1]
+                    goal, rest, alts, k, is_table, m, tlen = cp
+                    s.undo(m)
+                    del entries[tlen:]
+                    if trace:
+                        entries.append(("goal", goal, ()))
+                    while k < len(alts):  # a table's answers may grow while it is consumed
+                        if is_table:
+                            ans, ans_trace = alts[k]
+                            k += 1
+                            fresh[0] += 1
+                            if unify_args(goal.args, _rename(ans, f",{fresh[0]}").args, s):
+                                if trace:
+                                    names = dict(zip(_canonical(goal).args, goal.args))
+                                    entries.extend(_rename_entries(ans_trace, names))
+                                goals = rest
+                                break
+                        else:
+                            rid = alts[k]
+                            k += 1
+                            goals = resolve(rid, goal, s, rest, entries)
+                            if goals is not _NO_MATCH:
+                                break
+                    if goals is not _NO_MATCH:
+                        cp[3] = k
+                        break
+                    cps.pop()
+                else:
+                    # No choicepoint left: start the pass's next clause.
+                    while f.k < len(f.alts):
+                        rid = f.alts[f.k]
+                        f.k += 1
+                        s.undo(0)
+                        del entries[:]
+                        goals = resolve(rid, f.goal, s, None, entries)
+                        if goals is not _NO_MATCH:
+                            break
+                if goals is _NO_MATCH:
+                    break  # pass exhausted
                 continue
 
-            head_s = apply_subst_atom(r.head, s2)
-
-            if not r.body:
-                t2 = trace + [f"Goal: {goal}", f"  Matched FACT: {head_s}"]
-                res, tr = dfs(goals[1:], s2, depth + 1, t2)
-                if res is not None:
-                    return res, tr
+            atom, rest = goals
+            goal = apply_subst_atom(atom, s)
+            if (goal.pred, goal.args) in ground_facts:
+                # A ground fact: one deterministic success, no clause scan.
+                if trace:
+                    entries.append(("goal", goal, ()))
+                    entries.append(("fact", goal, ()))
+                goals = rest
+                continue
+            if (goal.pred, len(goal.args)) in tabled:
+                key = _canonical(goal)
+                if key not in table:
+                    table[key], seen[key] = [], set()
+                    cpos[key] = len(cstack)
+                    cstack.append(key)
+                    cps.append([goal, rest, table[key], 0, True, s.mark(), len(entries)])
+                    f.goals = _BACKTRACK
+                    f = start(key, False)
+                    frames.append(f)
+                    break
+                if key not in complete:
+                    # Incomplete: consume the answers found so far; the leader re-runs it later.
+                    f.dep = min(f.dep, cpos[key] if key in running else low[key])
+                cps.append([goal, rest, table[key], 0, True, s.mark(), len(entries)])
             else:
-                body_s = [apply_subst_atom(a, s2) for a in r.body]
-                body_str = ", ".join(str(a) for a in body_s)
-                t2 = trace + [f"Goal: {goal}", f"  Matched RULE: {head_s} :- {body_str}"]
-                res, tr = dfs(list(r.body) + goals[1:], s2, depth + 1, t2)
-                if res is not None:
-                    return res, tr
+                cps.append([goal, rest, program.candidates(goal), 0, False, s.mark(), len(entries)])
+            goals = _BACKTRACK
 
-        return None, trace + [f"Goal: {goal}", f"  Fail: {goal}"]
+        if goals is not _NO_MATCH:
+            continue  # switched to a new producer frame
+        if f.goal is None:
+            break  # the query has no (more) answers
+        # The pass over f's clauses is done.
+        running.discard(f.goal)
+        frames.pop()
+        if f.rerun:
+            leader = frames[-1]
+            leader.dep = min(leader.dep, f.dep)
+            f = leader
+        elif f.dep == cpos[f.goal]:
+            # Leader of a recursive component: re-run it and every table it left
+            # incomplete, once each per round, until a round adds no answer.
+            low[f.goal] = f.dep
+            f.members = []
+            frames.append(f)
+        else:
+            finish(f)
+            f = frames[-1]
+            continue
+        pos = cpos[f.goal]
+        if f.next == len(f.members):
+            if f.dep < pos or added[0] == f.before:
+                frames.pop()
+                finish(f)
+                f = frames[-1]
+                continue
+            f.before, f.members, f.next = added[0], cstack[pos:], 0
+        g = f.members[f.next]
+        f.next += 1
+        f = start(g, True)
+        frames.append(f)
 
-    subst, trace = dfs([query], {}, 0, [])
-    return (subst is not None), trace
+    if not trace:
+        return False, []
+    return False, [f"Goal: {_show(query)}", f"  Fail: {_show(query)}"]
@@ -1,15 +1,22 @@
 from __future__ import annotations
+import asyncio
+import functools
 from dataclasses import dataclass
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional, Tuple
 
 from langchain_openai import ChatOpenAI
-from langchain_core.output_parsers import JsonOutputParser
+from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage
 from langchain_core.runnables import RunnableLambda, RunnablePassthrough
 
+from .llm_json import parse_json
 from .logic_engine import Atom, parse_program, prove
 from .rag import build_retriever
 
-FORMULATE_PROMPT = """You are translating a natural language logic question into a Prolog-like Horn clause program.
+# The system message holds only the fixed instructions, so it is byte-identical on every
+# call; the retrieved snippets (which change per question) go in the user message.
+# Provider-side prefix caching only kicks in once the shared prefix passes its minimum
+# size (1,024 tokens for OpenAI), so a longer instruction block is what benefits.
+FORMULATE_SYSTEM = """You are translating a natural language logic question into a Prolog-like Horn clause program.
 
 You MUST output JSON with keys:
 - "program": string containing facts/rules (each ending with a period).
@@ -21,29 +28,43 @@ Constraints:
 - Variables start with uppercase letters (X, Y, Z).
 - No negation, no arithmetic, no lists.
 - Use the provided KB snippets as-is when possible instead of inventing new predicates.
+"""
 
-KB SNIPPETS:
+FORMULATE_USER = """KB SNIPPETS:
 {kb}
 
 QUESTION:
 {question}
 """
 
-REFINE_PROMPT = """Your previous symbolic program failed in the solver.
-
-ERROR:
-{error}
+REFINE_SYSTEM = """Your previous symbolic program failed in the solver.
 
 Fix the program/query to satisfy the constraints. Output the same JSON schema:
-{{
+{
   "program": "...",
   "query": "...."
-}}
+}
+"""
+
+REFINE_USER = """ERROR:
+{error}
 
 Original attempt:
 {attempt}
 """
 
+def _formulate_messages(kb: str, question: str) -> List[BaseMessage]:
+    return [
+        SystemMessage(content=FORMULATE_SYSTEM),
+        HumanMessage(content=FORMULATE_USER.format(kb=kb, question=question)),
+    ]
+
+def _refine_messages(error: str, attempt: Dict[str, Any]) -> List[BaseMessage]:
+    return [
+        SystemMessage(content=REFINE_SYSTEM),
+        HumanMessage(content=REFINE_USER.format(error=error, attempt=attempt)),
+    ]
+
 @dataclass
 class LogicLMResult:
     result: bool
@@ -51,7 +72,9 @@ class LogicLMResult:
     program: str
     trace: List[str]
     used_kb: List[str]
+    error: Optional[str] = None
 
+@functools.lru_cache(maxsize=256)
 def _parse_query_atom(q: str) -> Atom:
     q = q.strip().rstrip(".")
     if "(" not in q:
@@ -61,23 +84,44 @@ def _parse_query_atom(q: str) -> Atom:
     args = tuple(a.strip() for a in args.split(",") if a.strip())
     return Atom(pred.strip(), args)
 
-def _run_solver(payload: Dict[str, Any]) -> Dict[str, Any]:
-    program_text = payload["program"]
-    query_text = payload["query"].strip().rstrip(".") + "."
+def _to_result(attempt: Dict[str, Any], solved: Dict[str, Any], used_kb: List[str]) -> LogicLMResult:
+    return LogicLMResult(
+        result=bool(solved["ok"]),
+        query=attempt["query"],
+        program=attempt["program"],
+        trace=solved.get("trace", []),
+        used_kb=used_kb,
+        error=solved["error"],
+    )
 
+def _run_solver(payload: Dict[str, Any]) -> Dict[str, Any]:
     try:
+        # Inside the try: a malformed payload (e.g. a non-string query) is this
+        # question's error, not an exception that aborts a whole batch.
+        program_text = payload["program"]
+        query_text = payload["query"].strip().rstrip(".") + "."
         program = parse_program(program_text)
         query = _parse_query_atom(query_text)
-        ok, trace = prove(program, query)
+        ok, trace = prove(program, query, trace=True)
         return {"ok": ok, "trace": trace, "error": None}
     except Exception as e:
         return {"ok": False, "trace": [], "error": str(e)}
 
+def _check(resp: Any) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    # One LLM response (or the exception its call raised) -> (attempt, solved). Failed
+    # calls and unparsable output become a solver-style error, so they go through the
+    # refine step like any other failure instead of aborting the whole batch.
+    if isinstance(resp, Exception):
+        return {"program": "", "query": ""}, {"ok": False, "trace": [], "error": f"LLM call failed: {resp}"}
+    try:
+        attempt = parse_json(resp.content)
+    except ValueError as e:
+        return {"program": "", "query": ""}, {"ok": False, "trace": [], "error": str(e)}
+    return attempt, _run_solver(attempt)
+
 def build_logiclm_chain(kb_path: str, model: str = "gpt-4o-mini"):
     retriever = build_retriever(kb_path)
     llm = ChatOpenAI(model=model, temperature=0)
-    parser = JsonOutputParser()
-
     def retrieve_kb(question: str) -> Dict[str, Any]:
         docs = retriever.invoke(question)
         kb = "\n".join(d.page_content for d in docs)
@@ -85,19 +129,17 @@ def build_logiclm_chain(kb_path: str, model: str = "gpt-4o-mini"):
 
     formulate = (
         RunnableLambda(lambda x: retrieve_kb(x["question"]))
-        | RunnableLambda(lambda x: {"prompt": FORMULATE_PROMPT.format(kb=x["kb"], question=x["question"]), **x})
-        | RunnableLambda(lambda x: llm.invoke(x["prompt"]).content)
-        | parser
+        | RunnableLambda(lambda x: {"messages": _formulate_messages(x["kb"], x["question"]), **x})
+        | RunnableLambda(lambda x: llm.invoke(x["messages"]))
+        | RunnableLambda(_check)
     )
 
-    def maybe_refine(attempt: Dict[str, Any]) -> Dict[str, Any]:
-        solved = _run_solver(attempt)
+    def maybe_refine(checked: Tuple[Dict[str, Any], Dict[str, Any]]) -> Dict[str, Any]:
+        attempt, solved = checked
         if solved["error"] is None:
             return {**attempt, **solved, "refined": False}
 
-        prompt = REFINE_PROMPT.format(error=solved["error"], attempt=attempt)
-        fixed = parser.parse(llm.invoke(prompt).content)
-        solved2 = _run_solver(fixed)
+        fixed, solved2 = _check(llm.invoke(_refine_messages(solved["error"], attempt)))
         return {**fixed, **solved2, "refined": True, "original_error": solved["error"]}
 
     chain = (
@@ -115,6 +157,57 @@ def build_logiclm_chain(kb_path: str, model: str = "gpt-4o-mini"):
             program=out["program"],
             trace=out.get("trace", []),
             used_kb=used_kb,
+            error=out["error"],
         )
 
+    def run_batch(questions: List[str]) -> List[LogicLMResult]:
+        # Same pipeline as run(), but one retriever.batch and one llm.batch per stage.
+        # Failures stay per question: a bad response only sends that question to refine.
+        used_kbs = [[d.page_content for d in docs] for docs in retriever.batch(questions)]
+        resps = llm.batch(
+            [_formulate_messages("\n".join(kb), q) for kb, q in zip(used_kbs, questions)],
+            return_exceptions=True,
+        )
+        attempts, solved = map(list, zip(*map(_check, resps))) if resps else ([], [])
+
+        retry = [i for i, out in enumerate(solved) if out["error"] is not None]
+        if retry:
+            fixes = llm.batch(
+                [_refine_messages(solved[i]["error"], attempts[i]) for i in retry],
+                return_exceptions=True,
+            )
+            for i, r in zip(retry, fixes):
+                attempts[i], solved[i] = _check(r)
+
+        return [_to_result(a, out, kb) for a, out, kb in zip(attempts, solved, used_kbs)]
+
+    async def arun(question: str) -> LogicLMResult:
+        # Async run(): LLM/retriever calls are awaited and the CPU-bound solver runs in a
+        # worker thread, so concurrent questions overlap their network latency.
+        used_kb = [d.page_content for d in await retriever.ainvoke(question)]
+        resp = await llm.ainvoke(_formulate_messages("\n".join(used_kb), question))
+        attempt, solved = await asyncio.to_thread(_check, resp)
+        if solved["error"] is not None:
+            resp = await llm.ainvoke(_refine_messages(solved["error"], attempt))
+            attempt, solved = await asyncio.to_thread(_check, resp)
+        return _to_result(attempt, solved, used_kb)
+
+    async def arun_batch(questions: List[str], max_concurrency: int = 8) -> List[LogicLMResult]:
+        sem = asyncio.Semaphore(max_concurrency)
+
+        async def one(question: str) -> LogicLMResult:
+            async with sem:
+                return await arun(question)
+
+        # A question whose LLM/retriever call raises gets an error result; the rest keep theirs.
+        outs = await asyncio.gather(*(one(q) for q in questions), return_exceptions=True)
+        return [
+            LogicLMResult(result=False, query="", program="", trace=[], used_kb=[], error=str(o))
+            if isinstance(o, Exception) else o
+            for o in outs
+        ]
+
+    run.run_batch = run_batch
+    run.arun = arun
+    run.arun_batch = arun_batch
     return run
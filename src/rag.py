@@ -1,21 +1,79 @@
 from __future__ import annotations
+import functools
+import os
+import re
+from collections import Counter
 from pathlib import Path
 from langchain_community.vectorstores import FAISS
 from langchain_community.embeddings import FakeEmbeddings
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
 from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+# One stripped, non-empty, non-"%" line per match.
+_KB_LINE_RE = re.compile(r"^[^\S\n]*([^%\s][^\n]*?)\s*$", re.MULTILINE)
+
+def kb_lines_from_text(text: str) -> list[str]:
+    return _KB_LINE_RE.findall(text)
 
 def load_kb_lines(path: str) -> list[str]:
-    text = Path(path).read_text(encoding="utf-8")
-    lines = []
-    for raw in text.splitlines():
-        line = raw.strip()
-        if not line or line.startswith("%"):
-            continue
-        lines.append(line)
-    return lines
-
-def build_retriever(kb_path: str):
-    kb_lines = load_kb_lines(kb_path)
-    docs = [Document(page_content=l) for l in kb_lines]
-    vs = FAISS.from_documents(docs, embedding=FakeEmbeddings(size=256))
-    return vs.as_retriever(search_kwargs={"k": 8})
+    return kb_lines_from_text(Path(path).read_text(encoding="utf-8"))
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+def _tokens(text: str) -> list[str]:
+    return _TOKEN_RE.findall(text.lower())
+
+class TokenRetriever(BaseRetriever):
+    """
+    Inverted-index retriever for Prolog-fact KBs: ranks lines by how many query
+    tokens (predicate names, constants) they contain. Ties keep KB order.
+    """
+    lines: list[str]
+    postings: dict[str, list[int]]
+    k: int = 8
+
+    @classmethod
+    def from_lines(cls, lines: list[str], k: int = 8) -> "TokenRetriever":
+        postings: dict[str, list[int]] = {}
+        for i, line in enumerate(lines):
+            for tok in set(_tokens(line)):
+                postings.setdefault(tok, []).append(i)
+        return cls(lines=lines, postings=postings, k=k)
+
+    def as_retriever(self, **kwargs) -> "TokenRetriever":
+        k = kwargs.get("search_kwargs", {}).get("k", self.k)
+        return self if k == self.k else self.model_copy(update={"k": k})
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> list[Document]:
+        # One- and two-letter query words ("a", "is", "of") mostly hit constants
+        # like `a`/`b` in unrelated facts, so they don't count towards the score.
+        scores: Counter[int] = Counter()
+        for tok in set(_tokens(query)):
+            if len(tok) > 2:
+                scores.update(self.postings.get(tok, ()))
+        if not scores:
+            return [Document(page_content=l) for l in self.lines[: self.k]]
+        top = sorted(scores.items(), key=lambda kv: (-kv[1], kv[0]))[: self.k]
+        return [Document(page_content=self.lines[i]) for i, _ in top]
+
+@functools.lru_cache(maxsize=8)
+def _cached_token_retriever(kb_path: str, mtime: float) -> TokenRetriever:
+    return TokenRetriever.from_lines(load_kb_lines(kb_path))
+
+EMBEDDING_SIZE = 256
+
+@functools.lru_cache(maxsize=8)
+def _cached_vectorstore(kb_path: str, mtime: float, embedding_size: int) -> FAISS:
+    # In-process only: mtime is part of the key so an edited KB is re-indexed.
+    docs = [Document(page_content=l) for l in load_kb_lines(kb_path)]
+    return FAISS.from_documents(docs, embedding=FakeEmbeddings(size=embedding_size))
+
+def build_retriever(kb_path: str, use_faiss: bool = False):
+    # FakeEmbeddings are random, so FAISS gives no semantic ranking here; the token
+    # index is the default and FAISS stays available behind `use_faiss`.
+    mtime = os.stat(kb_path).st_mtime
+    if use_faiss:
+        vs = _cached_vectorstore(kb_path, mtime, EMBEDDING_SIZE)
+        return vs.as_retriever(search_kwargs={"k": 8})
+    return _cached_token_retriever(kb_path, mtime).as_retriever(search_kwargs={"k": 8})
@@ -0,0 +1,22 @@
+import pytest
+
+from src.llm_json import parse_json
+
+
+def test_parses_fenced_json():
+    text = '```json\n{"program": "p(a).", "query": "p(a)."}\n```'
+    assert parse_json(text) == {"program": "p(a).", "query": "p(a)."}
+
+
+@pytest.mark.parametrize("text", [
+    '{"program": "p(a)."}',
+    '{"program": "p(a).", "query": ["p(a)"]}',
+    '{"program": null, "query": "p(a)."}',
+])
+def test_rejects_missing_or_non_string_fields(text):
+    with pytest.raises(ValueError):
+        parse_json(text)
+
+
+def test_other_keys_keep_their_json_types():
+    assert parse_json('{"relevant": true, "reason": "ok"}', ("relevant", "reason"))["relevant"] is True
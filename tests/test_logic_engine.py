@@ -0,0 +1,107 @@
+from pathlib import Path
+
+from src.logic_engine import Atom, parse_program, prove
+
+FAMILY_KB = (Path(__file__).resolve().parents[1] / "kb" / "family_kb.pl").read_text(encoding="utf-8")
+
+
+def ask(program_text: str, pred: str, *args: str) -> bool:
+    return prove(parse_program(program_text), Atom(pred, args))[0]
+
+
+def test_long_predicate_chain_parses_and_proves():
+    text = "\n".join(f"g{i} :- g{i + 1}." for i in range(1000)) + "\ng1000."
+    program = parse_program(text)
+    assert not program.tabled
+    assert ask(text, "g0")
+
+
+def test_recursive_preds_are_tabled():
+    program = parse_program("a :- b.\nb :- c.\nc :- a.\nd :- d.\ne :- a.\nc.")
+    assert program.tabled == {("a", 0), ("b", 0), ("c", 0), ("d", 0)}
+
+
+def test_left_recursion_on_a_cycle_terminates():
+    text = """edge(a,b).
+edge(b,c).
+edge(c,a).
+edge(c,d).
+path(X,Y) :- path(X,Z), edge(Z,Y).
+path(X,Y) :- edge(X,Y).
+"""
+    assert ask(text, "path", "a", "d")
+    assert ask(text, "path", "a", "a")
+    assert not ask(text, "path", "d", "a")
+
+
+MUTUAL = """r1(X,Y) :- e(X,Y).
+r1(X,Y) :- r2(X,Z), r3(Z,Y).
+r2(X,Y) :- r3(X,Z), r1(Z,Y).
+r3(X,Y) :- r1(X,Z), r2(Z,Y).
+r2(X,Y) :- r1(X,Y).
+r3(X,Y) :- r1(X,Y).
+"""
+
+
+def test_mutual_recursion_over_a_cycle():
+    # Every node reaches every other along the 5-cycle, so r1 is the full relation.
+    text = MUTUAL + "".join(f"e(n{i},n{(i + 1) % 5}).\n" for i in range(5))
+    assert ask(text, "r1", "n0", "n3")
+    assert ask(text, "r1", "X", "n0")
+    assert not ask(text, "r1", "n0", "zz")
+
+
+def test_mutual_recursion_over_a_chain():
+    # r1 contains r1 composed with itself, so it is the transitive closure of e.
+    text = MUTUAL + "".join(f"e(n{i},n{i + 1}).\n" for i in range(6))
+    assert ask(text, "r1", "n0", "n6")
+    assert ask(text, "r1", "n2", "n4")
+    assert not ask(text, "r1", "n3", "n0")
+
+
+def test_many_interdependent_subgoals():
+    text = """f(Y).
+e(b,Y).
+e(a,X).
+p(W,Y) :- f(Y), f(Z).
+q(Y,c) :- f(Z), e(Z,Z), q(b,Y).
+q(X,Y) :- p(Z,X).
+q(c,X) :- q(Z,c), q(Z,Y), e(b,Z).
+q(b,Y) :- q(Z,Y), f(a), q(c,Y).
+"""
+    assert ask(text, "q", "A", "c")
+    assert not ask(text, "e", "c", "X")
+
+
+def test_clause_variables_are_renamed_apart():
+    assert ask("p(_G0, b).\nq(X) :- p(X, Y).", "q", "a")
+
+
+def test_deep_tabled_recursion_has_no_depth_cliff():
+    n = 3000
+    text = "path(X,Y) :- edge(X,Y).\npath(X,Y) :- edge(X,Z), path(Z,Y).\n"
+    text += "".join(f"edge(n{i},n{i + 1}).\n" for i in range(n))
+    assert ask(text, "path", "n0", f"n{n}")
+    assert not ask(text, "path", f"n{n}", "n0")
+
+
+def test_tabled_answer_trace_uses_the_callers_variable_names():
+    ok, lines = prove(parse_program(FAMILY_KB), Atom("ancestor", ("X", "emma")), trace=True)
+    assert ok
+    assert lines == [
+        "Goal: ancestor(X, emma)",
+        "  Matched RULE: ancestor(X, emma) :- parent(X, emma)",
+        "Goal: parent(X, emma)",
+        "  Matched FACT: parent(paul, emma)",
+    ]
+
+
+def test_head_matcher_is_built_only_for_hot_predicates():
+    text = "".join(f"p(c{i},d{i}).\n" for i in range(20)) + "q(a,b).\nq(b,c).\n"
+    program = parse_program(text)
+    assert not program.matchers
+    for i in range(20):
+        assert prove(program, Atom("p", ("X", f"d{i}")))[0]
+        assert prove(program, Atom("q", ("X", "c")))[0]
+    assert set(program.matchers) == {("p", 2)}
+    assert not prove(program, Atom("p", ("X", "d99")))[0]